@@ -1,66 +1,218 @@
 from __future__ import annotations
 
 import argparse
-from collections import deque
+import asyncio
+from collections.abc import AsyncIterator
+import contextlib
+import ipaddress
 import json
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
 import logging
+import mimetypes
+import multiprocessing
 import os
 from pathlib import Path
 from typing import Callable, final
 import re
+import signal
+import time
+from types import FrameType
 
 from aiohttp import web
 from aiohttp.typedefs import Middleware, Handler
-from mashumaro.mixins.json import DataClassJSONMixin
-from mashumaro import field_options
+import pytricia  # type: ignore[import-not-found]
+
+try:
+    from uvloop import new_event_loop
+except ImportError:  # uvloop is not available on Windows
+    from asyncio import new_event_loop  # type: ignore[assignment]
 
 logger = logging.getLogger("bot-trap")
 
+# A valid trap path, such as /bot-trap or /secret/trap.html
+TRAP_PATTERN = re.compile(r"/[A-Za-z0-9_\-][A-Za-z0-9_\-./]*")
+
 
 @final
 class Blocklist:
-    """An in-memory blocklist backed by a txt file."""
+    """An in-memory blocklist backed by a txt file.
+
+    Entries can be single IPs or CIDR networks, either IPv4 or IPv6. They are
+    indexed in a Patricia trie per IP version so lookups are a longest-prefix
+    match. pytricia matches across versions, so the versions must be kept apart.
+    """
+
+    __slots__ = (
+        "_file_path",
+        "_trie_v4",
+        "_trie_v6",
+        "_pending",
+        "_flush_threshold",
+        "_flush_interval",
+        "_last_flush_ts",
+        "_read_offset",
+        "_writes",
+        "_fd",
+    )
 
-    def __init__(self, file: Path) -> None:
+    def __init__(
+        self,
+        file: Path,
+        flush_threshold: int = 64,
+        flush_interval: float = 5.0,
+    ) -> None:
         self._file_path = file
-        self._list: set[str] = set()
+        self._trie_v4 = pytricia.PyTricia(32)
+        self._trie_v6 = pytricia.PyTricia(128)
         self._pending: list[str] = []
+        self._flush_threshold = flush_threshold
+        self._flush_interval = flush_interval
+        self._last_flush_ts = time.monotonic()
+        # how far into the file we've loaded IPs from
+        self._read_offset = 0
+        # writes to the file that are running in the executor
+        self._writes: set[asyncio.Future[int]] = set()
+        self._fd = os.open(file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
 
     def __contains__(self, ip: object) -> bool:
         """Whether the IP is blocked."""
-        return ip in self._list
+        if not isinstance(ip, str):
+            return False
+
+        trie = self._trie_v6 if ":" in ip else self._trie_v4
+        try:
+            return ip in trie
+        # pytricia raises SystemError instead of ValueError for some malformed keys
+        except (ValueError, SystemError):
+            return False
+
+    def _insert(self, network: ipaddress.IPv4Network | ipaddress.IPv6Network) -> None:
+        """Insert a network into the trie for its IP version."""
+        trie = self._trie_v4 if network.version == 4 else self._trie_v6
+        trie.insert(str(network), True)
+
+    def _insert_lines(self, data: bytes) -> int:
+        """Insert every line of some file contents. Return the number of entries."""
+        entries = [line.strip() for line in data.decode().splitlines() if line.strip()]
+        for entry in entries:
+            try:
+                self._insert(ipaddress.ip_network(entry, strict=False))
+            except ValueError:
+                logger.warning("Ignoring invalid blocklist entry '%s'.", entry)
+
+        return len(entries)
 
     @classmethod
     def from_file(cls, file: Path) -> Blocklist:
         """Load a blocklist from a file."""
-        with open(file, "r") as f:
-            ips = f.readlines()
-
         blocklist = cls(file)
-        blocklist._list.update(ips)
 
-        logger.info(f"Loaded {len(ips)} IPs from blocklist file.")
+        with open(file, "rb") as f:
+            data = f.read()
+
+        blocklist._read_offset = len(data)
+        if data and not data.endswith(b"\n"):
+            # don't append new IPs to the end of the last line
+            _ = os.write(blocklist._fd, b"\n")
+
+        n_loaded = blocklist._insert_lines(data)
+        logger.info("Loaded %d IPs from blocklist file.", n_loaded)
 
         return blocklist
 
+    def _read_appended(self) -> bytes:
+        """Read what was appended to the file since it was last read."""
+        with open(self._file_path, "rb") as f:
+            _ = f.seek(self._read_offset)
+            return f.read()
+
+    async def sync(self) -> None:
+        """Load the IPs other processes appended to the file since it was last read.
+
+        The file is read in the default executor, only the inserts run on the loop.
+        """
+        data = await asyncio.get_running_loop().run_in_executor(
+            None, self._read_appended
+        )
+
+        # a line that is still being written will be loaded on the next sync
+        data = data[: data.rfind(b"\n") + 1]
+        self._read_offset += len(data)
+
+        n_loaded = self._insert_lines(data)
+        if n_loaded > 0:
+            logger.debug("Loaded %d IPs appended to blocklist file.", n_loaded)
+
     def add(self, ip: str) -> None:
-        """Add IPs to the blocklist."""
-        self._list.update(ip)
-        self._pending.extend(ip)
-        logger.info(f"Blocked {ip}")
+        """Add an IP to the blocklist. Raise ValueError if it is not a valid IP."""
+        # only single IPs, so a client can't block a whole network through the trap
+        self._insert(ipaddress.ip_network(ipaddress.ip_address(ip)))
+        self._pending.append(ip + "\n")
+        logger.info("Blocked %s", ip)
+
+    @property
+    def flush_interval(self) -> float:
+        """How often, in seconds, pending IPs should be flushed to the file."""
+        return self._flush_interval
+
+    def maybe_flush(self) -> None:
+        """Flush the blocklist if enough IPs are pending or enough time has passed.
+
+        The write is started in the default executor and not waited for, so it
+        doesn't block the loop or the caller. Use wait_writes to wait for it.
+        """
+        if (
+            len(self._pending) < self._flush_threshold
+            and time.monotonic() - self._last_flush_ts < self._flush_interval
+        ):
+            return
+
+        data = self._take_pending()
+        if len(data) == 0:
+            return
+
+        write = asyncio.get_running_loop().run_in_executor(
+            None, os.write, self._fd, data
+        )
+        self._writes.add(write)
+        write.add_done_callback(self._on_write_done)
+
+    def _on_write_done(self, write: asyncio.Future[int]) -> None:
+        """Stop tracking a finished write and log it if it failed."""
+        self._writes.discard(write)
+        if not write.cancelled() and (ex := write.exception()) is not None:
+            logger.error("Failed to write to blocklist file: %s", ex)
+
+    def _take_pending(self) -> bytes:
+        """Take all pending IPs as a single buffer to be written to the file."""
+        self._last_flush_ts = time.monotonic()
+        if len(self._pending) == 0:
+            return b""
+
+        logger.info("Flushing %d new IPs to blocklist file.", len(self._pending))
+        data = "".join(self._pending).encode()
+        self._pending.clear()
+        return data
 
     def flush(self) -> None:
         """Flush the blocklist to the file."""
-        n_to_flush = len(self._pending)
-        with open(self._file_path, "a") as file:
-            file.writelines(self._pending)
-        self._pending = []
-        logger.info(f"Flushed {n_to_flush} new IPs to blocklist file.")
+        data = self._take_pending()
+        if len(data) > 0:
+            # a single write per batch, which O_APPEND keeps atomic between workers
+            _ = os.write(self._fd, data)
+
+    async def wait_writes(self) -> None:
+        """Wait for the writes started by maybe_flush to finish."""
+        _ = await asyncio.gather(*self._writes, return_exceptions=True)
 
+    def close(self) -> None:
+        """Flush pending IPs and close the blocklist file."""
+        self.flush()
+        os.close(self._fd)
 
-@dataclass
-class Options(DataClassJSONMixin):
+
+@dataclass(slots=True)
+class Options:
     """Server options."""
 
     # Path to the folder with public contents to serve
@@ -72,11 +224,9 @@ class Options(DataClassJSONMixin):
     # Path to the bullshit file
     bullshit: Path = Path("bullshit.html")
 
-    # Path to the blocklist file
-    blocklist_path: Path = field(
-        metadata=field_options(alias="blocklist"), default=Path("blocklist.txt")
-    )
-    blocklist: Blocklist = field(init=False, metadata=field_options("omit"))
+    # Path to the blocklist file, set by the `blocklist` config entry
+    blocklist_path: Path = Path("blocklist.txt")
+    blocklist: Blocklist = field(init=False)
 
     # Port to listen on
     host: str = "0.0.0.0"
@@ -87,6 +237,9 @@ class Options(DataClassJSONMixin):
     # Whethere bot-trap is sitting behind a reverse proxy
     proxy: bool = False
 
+    # Number of server processes listening on the same port
+    workers: int = 1
+
     # The trap path
     trap: str = "/bot-trap"
 
@@ -95,15 +248,15 @@ class Options(DataClassJSONMixin):
     anchor: Path | None = None
 
     def __post_init__(self) -> None:
-        pat = re.compile(r"\/[A-z0-9\-\_]")
-        assert pat.match(self.trap), "trap must be valid HTTP path"
+        assert TRAP_PATTERN.fullmatch(self.trap), "trap must be valid HTTP path"
+        assert self.workers >= 1, "workers must be at least 1"
 
-        anchor = self.anchor or os.getcwd()
+        anchor = os.fspath(self.anchor or os.getcwd())
 
-        self.public = Path(os.path.join(anchor, self.public))
-        self.not_found = Path(os.path.join(self.public, self.not_found))
-        self.bullshit = Path(os.path.join(anchor, self.bullshit))
-        self.blocklist_path = Path(os.path.join(anchor, self.blocklist_path))
+        self.public = Path(anchor, self.public)
+        self.not_found = Path(self.public, self.not_found)
+        self.bullshit = Path(anchor, self.bullshit)
+        self.blocklist_path = Path(anchor, self.blocklist_path)
 
         self.blocklist = Blocklist.from_file(self.blocklist_path)
 
@@ -112,49 +265,141 @@ class Options(DataClassJSONMixin):
         abs_path = os.path.realpath(file)
 
         with open(abs_path, "r") as f:
-            raw_config = json.loads(f.read())
+            raw_config = json.load(f)
 
         if "anchor" not in raw_config:
             raw_config["anchor"] = os.path.dirname(abs_path)
 
-        return cls.from_dict(raw_config)
+        if "blocklist" in raw_config:
+            raw_config["blocklist_path"] = raw_config.pop("blocklist")
+
+        known = {f.name for f in fields(cls) if f.init}
+        unknown = raw_config.keys() - known
+        if unknown:
+            raise ValueError(f"Unknown config entries: {', '.join(sorted(unknown))}")
+
+        return cls(**raw_config)
 
 
 NO_CACHE = {"Cache-Control": "no-cache"}
 
+# Files bigger than this are streamed with sendfile instead of kept in memory
+MAX_IN_MEMORY_BODY = 64 * 1024
+
+
+def get_body_headers(
+    body: bytes, content_type: str, extra: dict[str, str] | None = None
+) -> dict[str, str]:
+    """Get the headers for a precomputed body, so they aren't rebuilt per request."""
+    return {
+        "Content-Type": content_type,
+        "Content-Length": str(len(body)),
+        **(extra or {}),
+    }
 
-def get_ip_getter(opts: Options) -> Callable[[web.Request], str | None]:
-    """Return a function that gets the client IP from a request."""
 
-    def proxy(req: web.Request) -> str | None:
-        return req.headers.get("x-forwarded-for")
+def load_body(
+    path: Path, extra: dict[str, str] | None = None
+) -> tuple[bytes, dict[str, str]]:
+    """Load a file into memory along with the headers to serve it with.
 
-    def no_proxy(req: web.Request) -> str | None:
-        return req.remote
+    A missing file is served as an empty body.
+    """
+    try:
+        with open(path, "rb") as f:
+            body = f.read()
+    except FileNotFoundError:
+        logger.warning("File '%s' not found, serving an empty body instead.", path)
+        body = b""
 
-    return proxy if opts.proxy else no_proxy
+    content_type, _ = mimetypes.guess_type(path)
+    headers = get_body_headers(body, content_type or "application/octet-stream", extra)
+    return body, headers
+
+
+def get_file_responder(
+    path: Path, status: int = 200, extra: dict[str, str] | None = None
+) -> Callable[[], web.StreamResponse]:
+    """Get a function that returns a response with the contents of a file.
+
+    Small files are loaded in memory once. Big files are served with a
+    FileResponse, which lets the kernel copy them to the socket with sendfile.
+    A missing file is served as an empty body.
+    """
+    try:
+        size = os.path.getsize(path)
+    except FileNotFoundError:
+        # load_body serves it as an empty body
+        size = 0
+
+    if size > MAX_IN_MEMORY_BODY:
+
+        def file_response() -> web.StreamResponse:
+            return web.FileResponse(path=path, status=status, headers=extra)
+
+        return file_response
+
+    body, headers = load_body(path, extra)
+
+    def memory_response() -> web.StreamResponse:
+        return web.Response(body=body, status=status, headers=headers)
+
+    return memory_response
 
 
 def get_blocklist_middleware(opts: Options) -> Middleware:
-    """Get a middleware that blocks people that are in the blocklist."""
-    ip_getter = get_ip_getter(opts)
+    """Get a middleware that blocks people that are in the blocklist.
+
+    The way the client IP is read is baked into the middleware depending on
+    `opts.proxy`, so it isn't decided again on every request. Requests to the
+    trap skip the blocklist, so repeat offenders still reach the trap handler.
+    """
+    blocklist = opts.blocklist
+    trap = opts.trap
+    bullshit_response = get_file_responder(opts.bullshit, extra=NO_CACHE)
 
     @web.middleware
-    async def middleware(request: web.Request, handler: Handler) -> web.StreamResponse:
-        ip = ip_getter(request)
-        blocked = ip in opts.blocklist
+    async def proxy_middleware(
+        request: web.Request, handler: Handler
+    ) -> web.StreamResponse:
+        ip = request.headers.get("x-forwarded-for")
+        request["ip"] = ip
+        if request.path == trap:
+            return await handler(request)
+
+        blocked = ip in blocklist
+        request["blocked"] = blocked
+
+        logger.info("%s: blocked=%s", ip, blocked)
+        if blocked:
+            return bullshit_response()
+
+        return await handler(request)
 
-        logger.info(f"{ip}: blocked={blocked}")
+    @web.middleware
+    async def no_proxy_middleware(
+        request: web.Request, handler: Handler
+    ) -> web.StreamResponse:
+        ip = request.remote
+        request["ip"] = ip
+        if request.path == trap:
+            return await handler(request)
+
+        blocked = ip in blocklist
+        request["blocked"] = blocked
+
+        logger.info("%s: blocked=%s", ip, blocked)
         if blocked:
-            return web.FileResponse(path=opts.bullshit, headers=NO_CACHE)
+            return bullshit_response()
 
         return await handler(request)
 
-    return middleware
+    return proxy_middleware if opts.proxy else no_proxy_middleware
 
 
 def get_not_found_middleware(opts: Options) -> Middleware:
     """Get a middleware that returns the 404 file for all not found requests."""
+    not_found_response = get_file_responder(opts.not_found, status=404)
 
     @web.middleware
     async def middleware(request: web.Request, handler: Handler) -> web.StreamResponse:
@@ -166,47 +411,92 @@ def get_not_found_middleware(opts: Options) -> Middleware:
             if ex.status != 404:
                 raise
 
-        return web.FileResponse(path=opts.not_found, status=404)
+        return not_found_response()
 
     return middleware
 
 
 def get_trap_handler(opts: Options) -> Handler:
-    ip_getter = get_ip_getter(opts)
-
     async def handler(req: web.Request) -> web.Response:
         """Anyone who visits this will get added to the blocklist."""
-        ip = ip_getter(req)
+        # set by the blocklist middleware
+        ip: str | None = req.get("ip")
         user_agent = req.headers.get("user-agent")
 
         if not ip:
             logger.error("User IP not present in request.")
             return web.Response(body="ok")
 
-        logger.info(f"blocking ip={ip} user-agent='{user_agent}'")
-        opts.blocklist.add(ip)
-        opts.blocklist.flush()
+        if ip in opts.blocklist:
+            logger.info(
+                "blocked ip=%s hit the trap again user-agent='%s'", ip, user_agent
+            )
+            return web.Response(body="ok", headers=NO_CACHE)
+
+        logger.info("blocking ip=%s user-agent='%s'", ip, user_agent)
+        try:
+            opts.blocklist.add(ip)
+        except ValueError:
+            logger.error("Invalid user IP '%s'.", ip)
+            return web.Response(body="ok")
+
+        opts.blocklist.maybe_flush()
 
         return web.Response(body="ok", headers=NO_CACHE)
 
     return handler
 
 
+def get_blocklist_flush_ctx(
+    opts: Options,
+) -> Callable[[web.Application], AsyncIterator[None]]:
+    """Get a cleanup context that periodically flushes the blocklist to its file.
+
+    With multiple workers, it also loads the IPs blocked by the other workers.
+    """
+
+    async def flush_periodically() -> None:
+        while True:
+            await asyncio.sleep(opts.blocklist.flush_interval)
+            # keep going on errors, or nothing would be flushed or synced again
+            try:
+                opts.blocklist.maybe_flush()
+                if opts.workers > 1:
+                    await opts.blocklist.sync()
+            except Exception:
+                logger.exception("Failed to flush or sync the blocklist file.")
+
+    async def ctx(_app: web.Application) -> AsyncIterator[None]:
+        task = asyncio.create_task(flush_periodically())
+        yield
+        _ = task.cancel()
+        try:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+            await opts.blocklist.wait_writes()
+        finally:
+            opts.blocklist.close()
+
+    return ctx
+
+
 def get_robots_txt_handler(opts: Options) -> Handler:
     robots_txt_path = os.path.join(opts.public, "robots.txt")
 
     if os.path.isfile(robots_txt_path):
-        with open(robots_txt_path, "r") as f:
+        # served as-is, so there's no need to decode it
+        with open(robots_txt_path, "rb") as f:
             contents = f.read()
     else:
-        contents = ""
+        contents = b""
 
-    inject = f"User-Agent: *\nDisallow: {opts.trap}\n\n"
-    contents = inject + contents
+    inject = f"User-Agent: *\nDisallow: {opts.trap}\n\n".encode()
+    body = inject + contents
+    headers = get_body_headers(body, "text/plain; charset=utf-8")
 
     async def handler(_: web.Request) -> web.Response:
         """Return the modified robots.txt."""
-        return web.Response(body=contents)
+        return web.Response(body=body, headers=headers)
 
     return handler
 
@@ -214,37 +504,23 @@ def get_robots_txt_handler(opts: Options) -> Handler:
 def get_static_handler(opts: Options) -> Handler:
     """Get a list of all files. This will load all files in memory."""
 
-    files: list[Path] = []
-    to_scan: deque[Path] = deque([opts.public])
-
-    while len(to_scan) > 0:
-        curr = to_scan.pop()
-
-        for entry in os.scandir(curr):
-            full_path = Path(os.path.join(curr, entry.path))
-            if entry.is_file():
-                files.append(full_path)
-            elif entry.is_dir():
-                to_scan.append(full_path)
+    routes: dict[str, str] = {}
+    for dir_path, _, file_names in os.walk(opts.public, followlinks=True):
+        for file_name in file_names:
+            file = os.path.join(dir_path, file_name)
+            rel_path = "/" + os.path.relpath(file, opts.public).replace(os.sep, "/")
 
-    routes: dict[str, Path] = {}
-    for file in files:
-        file_str = str(file)
-        rel_path = file_str[len(str(opts.public)) :]
+            routes[rel_path] = file
 
-        routes[rel_path] = file
+            if file_name == "index.html":
+                # resolve /dir/ to /dir/index.html
+                dir_name_slash = rel_path.removesuffix("index.html")
+                routes[dir_name_slash] = file
 
-        file_name = os.path.basename(file)
-
-        if file_name == "index.html":
-            # resolve /dir/ to /dir/index.html
-            dir_name_slash = rel_path.rstrip("index.html")
-            routes[dir_name_slash] = file
-
-            # resolve /dir to /dir/index.html
-            dir_name_no_slash = rel_path.rstrip("/index.html")
-            if dir_name_no_slash != "":
-                routes[dir_name_no_slash] = file
+                # resolve /dir to /dir/index.html
+                dir_name_no_slash = dir_name_slash.removesuffix("/")
+                if dir_name_no_slash != "":
+                    routes[dir_name_no_slash] = file
 
     async def handler(req: web.Request) -> web.StreamResponse:
         """Return the file if it exists robots.txt."""
@@ -263,23 +539,15 @@ def get_static_handler(opts: Options) -> Handler:
     return handler
 
 
-def main() -> None:
-    logging.basicConfig(level=logging.INFO)
-
-    parser = argparse.ArgumentParser()
-    _ = parser.add_argument(
-        "config_file",
-        help="bot-trap.json config file.",
-    )
-    namespace = parser.parse_args()
-    opts = Options.from_file(Path(namespace.config_file))
-
+def get_app(opts: Options) -> web.Application:
+    """Get the bot-trap application."""
     app = web.Application(
         middlewares=[
             get_blocklist_middleware(opts),
             get_not_found_middleware(opts),
         ]
     )
+    app.cleanup_ctx.append(get_blocklist_flush_ctx(opts))
     _ = app.add_routes(
         [
             web.get(opts.trap, get_trap_handler(opts)),
@@ -288,7 +556,95 @@ def main() -> None:
         ]
     )
 
-    web.run_app(app, host=opts.host, port=opts.port)
+    return app
+
+
+def get_parent_watch_ctx(
+    parent_pid: int,
+) -> Callable[[web.Application], AsyncIterator[None]]:
+    """Get a cleanup context that shuts the worker down when its parent dies."""
+
+    async def watch_parent() -> None:
+        while os.getppid() == parent_pid:
+            await asyncio.sleep(1)
+
+        logger.warning("Parent process died, shutting down worker.")
+        # run_app shuts down gracefully on SIGTERM
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    async def ctx(_app: web.Application) -> AsyncIterator[None]:
+        task = asyncio.create_task(watch_parent())
+        yield
+        _ = task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+    return ctx
+
+
+def serve(
+    opts: Options, reuse_port: bool = False, parent_pid: int | None = None
+) -> None:
+    """Serve bot-trap until interrupted."""
+    app = get_app(opts)
+    if parent_pid is not None:
+        app.cleanup_ctx.append(get_parent_watch_ctx(parent_pid))
+
+    web.run_app(
+        app,
+        host=opts.host,
+        port=opts.port,
+        reuse_port=reuse_port,
+        loop=new_event_loop(),
+    )
+
+
+def serve_worker(config_file: Path, parent_pid: int) -> None:
+    """Serve bot-trap from a worker process that shares the port with others."""
+    logging.basicConfig(level=logging.INFO)
+    serve(Options.from_file(config_file), reuse_port=True, parent_pid=parent_pid)
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    _ = parser.add_argument(
+        "config_file",
+        help="bot-trap.json config file.",
+    )
+    namespace = parser.parse_args()
+    config_file = Path(namespace.config_file)
+    opts = Options.from_file(config_file)
+
+    if opts.workers == 1:
+        serve(opts)
+        return
+
+    # every worker loads its own options and blocklist
+    opts.blocklist.close()
+    workers = [
+        multiprocessing.Process(target=serve_worker, args=(config_file, os.getpid()))
+        for _ in range(opts.workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    def terminate_workers(_signum: int, _frame: FrameType | None) -> None:
+        # the workers shut down gracefully on SIGTERM, and are joined below
+        for worker in workers:
+            worker.terminate()
+
+    # installed after starting the workers so they don't inherit it
+    _ = signal.signal(signal.SIGTERM, terminate_workers)
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # the workers got the same interrupt and are shutting down on their own
+        for worker in workers:
+            worker.join()
 
 
 if __name__ == "__main__":